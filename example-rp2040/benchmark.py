@@ -5,6 +5,7 @@
 # Run benchmark and calculate whether playback is real time.
 
 import argparse
+import numpy as np
 import pandas as pd
 import io
 import serial
@@ -12,21 +13,30 @@ from halo import Halo
 from pathlib import Path
 
 
+# In increasing order, --measure relies on that
+BITRATES = ("8k", "12k", "16k", "24k", "32k", "48k", "64k")
+BITRATE_CHOICES = frozenset(BITRATES + ("custom",))
+FREQ_CHOICES = frozenset(("8khz", "12khz", "16khz", "24khz", "48khz"))
+
+# Upper bound for one table, enough for a custom sample filling the flash
+MAX_OUTPUT_SIZE = 1 << 24
+
+
 def bitrate(s):
     s = s.lower()
-    if s in ["8k", "12k", "16k", "24k", "32k", "48k", "64k", "custom"]:
+    if s in BITRATE_CHOICES:
         return s
     raise ValueError
 
 
 def freq(s):
     s = s.lower()
-    if s in ["8khz", "12khz", "16khz", "24khz", "48khz"]:
+    if s in FREQ_CHOICES:
         return s
     raise ValueError
 
 
-def build_command(args):
+def build_command_prefix(args):
     if args.play_only:
         command = b"play"
     else:
@@ -38,64 +48,90 @@ def build_command(args):
     if args.freq:
         command += f" {args.freq}".encode()
 
-    if args.bitrate:
-        command += f" {args.bitrate}".encode()
+    return command
+
+
+def build_command(prefix, bitrate):
+    if bitrate:
+        return prefix + f" {bitrate}".encode() + b"\r\n"
+    return prefix + b"\r\n"
+
 
-    return command + b"\r\n"
+def read_until_prompt(s, limit=MAX_OUTPUT_SIZE):
+    content = bytearray()
+    # Device stays silent while playing, so keep waiting after timeouts
+    while not content.endswith(b"> "):
+        content.extend(s.read(max(1, s.in_waiting)))
+        if len(content) > limit:
+            raise ValueError("Output too long")
+    return content
+
+
+def open_port(args):
+    return serial.Serial(args.serial_port, baudrate=args.baudrate, timeout=10)
 
 
 @Halo(text="Decoding", spinner="dots", placement="right")
-def get_output(command, serial_port, baudrate):
-    with serial.Serial(serial_port, baudrate=baudrate, timeout=10) as s:
-        s.reset_input_buffer()
-        s.write(b"\r\n")
-        s.flush()
-        content = s.read_until(b"> ")
-        assert content.endswith(b"> ")
-        s.write(command)
-        s.flush()
-        content = s.read_until(b"\r\n")
-        assert content == command
-
-        def get_until(sio, until=b"> "):
-            content = bytes()
-            while not content.endswith(b"> "):
-                content += s.read_until(b"> ")
-                if not content.endswith(b"\r\n"):
-                    *lines, last = content.split(b"\r\n")
-                else:
-                    last = bytes()
-                    lines = content.split(b"\r\n")
-                yield from map(lambda line: line.decode(), lines)
-                content = last
+def get_output(command, s):
+    s.reset_input_buffer()
+    s.write(b"\r\n")
+    s.flush()
+    content = s.read_until(b"> ")
+    assert content.endswith(b"> ")
+    s.write(command)
+    s.flush()
+    content = s.read_until(b"\r\n", size=len(command))
+    assert content == command
+    return read_until_prompt(s)
 
-        content = list(get_until(s))
-        return "\n".join(content)[:-2]
 
+def read_table(content, columns=None):
+    data = io.BytesIO(content[:-2])
+    if columns is None:
+        df = pd.read_csv(data, skipinitialspace=True)
+    else:
+        df = pd.read_csv(
+            data,
+            skipinitialspace=True,
+            usecols=columns,
+            dtype={column: "float32" for column in columns},
+        )
+    # Compute speeds in float64 regardless of how the columns were parsed
+    sample_time = df["sample time"].astype("float64")
+    df["decode speed"] = sample_time / df["decode time"]
+    if "playback time" in df:
+        df["playback speed"] = sample_time / df["playback time"]
+    return df
 
-def read_table(content):
-    data = io.StringIO(content)
-    return pd.read_csv(data, skipinitialspace=True, lineterminator="\n")
+
+def speed_stats(speed):
+    # Match pandas: skip NaN and give NaN for too few values
+    speed = speed[~np.isnan(speed)]
+    if speed.size == 0:
+        return np.nan, np.nan, np.nan, np.nan
+    variance = speed.var(ddof=1) if speed.size > 1 else np.nan
+    return speed.mean(), variance, speed.min(), speed.max()
 
 
 def print_report(df):
-    decode_speed = df["sample time"] / df["decode time"]
-    if (decode_speed < 1).any():
+    mean, variance, minimum, maximum = speed_stats(df["decode speed"].to_numpy())
+    if minimum < 1:
         print("Too slow to decode some frames")
     else:
         print("Fast enough to decode all frames")
 
-    print(f"Mean decode speed: {decode_speed.mean() * 100 :.1f} %")
-    print(f"Variance of decode speed: {decode_speed.var() * 100:.3f} %pt.")
-    print(f"Minimum decode speed: {decode_speed.min() * 100 :.1f} %")
-    print(f"Maximum decode speed: {decode_speed.max() * 100 :.1f} %")
+    print(f"Mean decode speed: {mean * 100 :.1f} %")
+    print(f"Variance of decode speed: {variance * 100:.3f} %pt.")
+    print(f"Minimum decode speed: {minimum * 100 :.1f} %")
+    print(f"Maximum decode speed: {maximum * 100 :.1f} %")
 
     # Skip first few packets as they are not representative
-    playback_speed = df["sample time"][3:-1] / df["playback time"][3:-1]
-    print(f"Mean playback speed: {playback_speed.mean() * 100 :.1f} %")
-    print(f"Variance of playback speed: {playback_speed.var() * 100:.3f} %pt.")
-    print(f"Minimum playback speed: {playback_speed.min() * 100 :.1f} %")
-    print(f"Maximum playback speed: {playback_speed.max() * 100 :.1f} %")
+    playback_speed = df["playback speed"].to_numpy()[3:-1]
+    mean, variance, minimum, maximum = speed_stats(playback_speed)
+    print(f"Mean playback speed: {mean * 100 :.1f} %")
+    print(f"Variance of playback speed: {variance * 100:.3f} %pt.")
+    print(f"Minimum playback speed: {minimum * 100 :.1f} %")
+    print(f"Maximum playback speed: {maximum * 100 :.1f} %")
 
 
 def main():
@@ -137,6 +173,13 @@ def main():
         default=False,
         help="Test different bitrates to find the best that decodes real-time",
     )
+    parser.add_argument(
+        "--exhaustive",
+        action="store_true",
+        default=False,
+        help="With --measure, keep measuring higher bitrates after one fails to "
+        "decode real-time",
+    )
     parser.add_argument(
         "-f",
         "--freq",
@@ -163,50 +206,51 @@ def main():
         help="Baudrate for the serial port",
     )
     args = parser.parse_args()
+    if args.exhaustive and not args.measure:
+        parser.error("--exhaustive requires --measure")
 
     if args.measure:
         if args.save_table is not None:
             args.save_table = open(args.save_table, "w")
+        prefix = build_command_prefix(args)
         data = []
-        for bitrate_ in ["8k", "12k", "16k", "24k", "32k", "48k", "64k"]:
-            args.bitrate = bitrate_
-            command = build_command(args)
-            content = get_output(command, args.serial_port, args.baudrate)
-            df = read_table(content)
-            if args.print_table:
-                print(f"With {bitrate_[:-1]} kb/s")
-                print(df.to_string())
-            if args.save_table is not None:
-                args.save_table.write(f"With {bitrate_[:-1]} kb/s\n")
-                df.to_csv(args.save_table)
-                args.save_table.write("\n\n")
-            decode_speed = df["sample time"] / df["decode time"]
-            data.append(
-                [
-                    bitrate_,
-                    (decode_speed >= 1).all(),
-                    decode_speed.mean(),
-                    decode_speed.var(),
-                    decode_speed.min(),
-                    decode_speed.max(),
-                ]
-            )
+        with open_port(args) as port:
+            for bitrate_ in BITRATES:
+                command = build_command(prefix, bitrate_)
+                content = get_output(command, port)
+                if args.print_table or args.save_table is not None:
+                    df = read_table(content)
+                else:
+                    df = read_table(content, columns=["sample time", "decode time"])
+                if args.print_table:
+                    print(f"With {bitrate_[:-1]} kb/s")
+                    print(df.to_string())
+                if args.save_table is not None:
+                    table = df.to_csv(lineterminator="\n")
+                    args.save_table.write(f"With {bitrate_[:-1]} kb/s\n{table}\n\n")
+                decode_speed = df["decode speed"].to_numpy()
+                mean, variance, minimum, maximum = speed_stats(decode_speed)
+                real_time = minimum >= 1
+                data.append([bitrate_, real_time, mean, variance, minimum, maximum])
+                if not real_time and not args.exhaustive:
+                    break
         if args.save_table:
             args.save_table.close()
         df = pd.DataFrame(
             data,
             columns=["bitrate", "real time", "mean", "variance", "minimum", "maximum"],
         )
-        df["real time"] = df["real time"].map(lambda x: "yes" if x else "no")
-        df["mean"] = df["mean"].map(lambda x: f"{x * 100:.1f} %")
-        df["variance"] = df["variance"].map(lambda x: f"{x * 100:.3f} %pt.")
-        df["minimum"] = df["minimum"].map(lambda x: f"{x * 100:.1f} %")
-        df["maximum"] = df["maximum"].map(lambda x: f"{x * 100:.1f} %")
+        df["real time"] = df["real time"].map({True: "yes", False: "no"})
+        df["mean"] = (df["mean"] * 100).map("{:.1f} %".format)
+        df["variance"] = (df["variance"] * 100).map("{:.3f} %pt.".format)
+        df["minimum"] = (df["minimum"] * 100).map("{:.1f} %".format)
+        df["maximum"] = (df["maximum"] * 100).map("{:.1f} %".format)
         print(df)
     else:
-        command = build_command(args)
-        content = get_output(command, args.serial_port, args.baudrate)
-        if content.startswith("Invalid command"):
+        command = build_command(build_command_prefix(args), args.bitrate)
+        with open_port(args) as port:
+            content = get_output(command, port)
+        if content.startswith(b"Invalid command"):
             print(f"Cannot play '{args.bitrate}'")
             return
         if not args.play_only: